@@ -28,10 +28,59 @@ PREMADE_VOICES = [
     "eponine",
     "azelma",
 ]
+PREMADE_VOICES_SET = frozenset(PREMADE_VOICES)  # O(1) membership checks
 
 # Performance Configuration
+# pocket-tts's own dynamic int8 path: quantizes the transformer's Linear
+# layers and keeps the flow net and Mimi decoder in fp32 for audio quality
+QUANTIZE_INT8 = os.getenv("TTS_QUANT", "1") == "1"
+# torch.compile the flow LM at startup. Off by default: Inductor needs a C++
+# compiler on CPU, which the python:3.10-slim image does not ship.
+TORCH_COMPILE = os.getenv("TTS_COMPILE", "0") == "1"
 MAX_TEXT_LENGTH = 10000  # Maximum characters per request
+# Upper bound for concurrent generations (limiter and thread pool size).
+# pocket-tts generation on a shared model is not thread-safe, hence 1.
+MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", "1"))
 STREAM_BUFFER_SIZE = 3  # Number of chunks to buffer before streaming
+# Coalesce streamed frames into chunks of at least this many samples (0 = off).
+# Larger values mean fewer messages but can underrun playback on slow CPUs.
+STREAM_COALESCE_SAMPLES = int(os.getenv("TTS_STREAM_COALESCE_SAMPLES", "0"))
+VOICE_CACHE_MAX_ENTRIES = int(os.getenv("VOICE_CACHE_MAX_ENTRIES", "32"))  # Max cached voice states
+VOICE_CACHE_MB = int(os.getenv("VOICE_CACHE_MB", "512"))  # Memory budget for cached voice states
+VOICE_PATH_CACHE_TTL = float(os.getenv("VOICE_PATH_CACHE_TTL", "5"))  # Seconds to reuse voice file lookups
+
+
+
+def _available_cpus() -> int:
+    """CPUs this process may actually use: affinity mask capped by any cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on Windows/macOS
+        cpus = os.cpu_count() or 1
+    
+    # os.cpu_count() and the affinity mask ignore CFS quotas (docker --cpus,
+    # compose `cpus:`), so read the quota from cgroup v2, falling back to v1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        try:
+            quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+            period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+            if quota > 0:
+                cpus = min(cpus, max(1, quota // period))
+        except (OSError, ValueError):
+            pass
+    return cpus
+
+
+# CPU threading: PyTorch intra-op threads per process. Defaults to the CPUs
+# available to the container, split across Gunicorn workers (see post_fork).
+# Set TTS_TORCH_THREADS to pin it explicitly.
+CPU_COUNT = _available_cpus()
+_torch_threads = os.getenv("TTS_TORCH_THREADS")
+TORCH_THREADS = int(_torch_threads) if _torch_threads else None
 
 # Create necessary directories
 MODEL_CACHE_DIR.mkdir(exist_ok=True)
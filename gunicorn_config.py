@@ -35,8 +35,50 @@ loglevel = "info"
 # Process naming
 proc_name = "pocket-tts-production"
 
-# Preload app to save memory (Shared memory for torch model?)
-# Warning: Preload can cause issues with CUDA/multiprocessing if not careful.
-# For CPU-only PyTorch, preloading *might* save RAM but `fork` safety is tricky.
-# We disable it by default for safety, let workers load model independently.
-preload_app = False
+# Preload app to save memory
+# The model is loaded once in the master (see when_ready) and workers share its
+# read-only weight pages through copy-on-write fork().
+# CUDA cannot be re-initialized in a forked child, so GPU hosts keep loading
+# the model independently in each worker. The NVML-based check answers
+# is_available() without initializing CUDA in the master, and GUNICORN_PRELOAD
+# (1/0) overrides the detection entirely.
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+import torch
+
+_preload_override = os.getenv("GUNICORN_PRELOAD")
+if _preload_override is not None:
+    preload_app = _preload_override == "1"
+else:
+    preload_app = not torch.cuda.is_available()
+
+
+def when_ready(server):
+    """Prepare shared state before workers start.
+
+    With preload_app, loads the TTS engine in the master so every worker
+    inherits the model and preloaded voices instead of loading its own.
+    The master stays single-threaded while doing so: libgomp's thread pool
+    does not survive fork(), and a child forked from a parent that ran
+    multi-threaded torch ops hangs on its first parallel op. post_fork then
+    gives each worker its own thread count.
+    """
+    if server.cfg.preload_app:
+        from tts_engine import get_engine
+
+        # Covers model load and voice preloading in TTSEngine.__init__
+        torch.set_num_threads(1)
+        get_engine()
+        server.log.info("TTS engine preloaded in master")
+
+
+def post_fork(server, worker):
+    """Split CPU cores between workers to avoid intra-op thread oversubscription.
+
+    Uses the CPUs available to the container (affinity and cgroup quota, not
+    host cores) unless TTS_TORCH_THREADS pins the count explicitly.
+    """
+    import config
+
+    num_threads = config.TORCH_THREADS or max(1, config.CPU_COUNT // server.cfg.workers)
+    os.environ["TTS_TORCH_THREADS"] = str(num_threads)
+    torch.set_num_threads(num_threads)
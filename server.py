@@ -1,14 +1,19 @@
 """FastAPI server for real-time TTS with WebSocket streaming."""
 
 import asyncio
+import base64
+import functools
 import io
 import json
+import struct
 import time
+from contextlib import aclosing
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
-import scipy.io.wavfile
+import soundfile as sf
+import torch
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Request
 from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -19,15 +24,137 @@ import uvicorn
 import config
 from tts_engine import get_engine
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel
 from typing import List, Optional, Union, Literal
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
 # Concurrency control
-# Limit concurrent generations to avoid CPU thrashing
-# Adjust based on CPU cores. For PocketTTS 100M, 1-2 concurrent is often max for real-time on standard CPUs.
-concurrency_semaphore = asyncio.Semaphore(2)
+# pocket-tts generation is not thread-safe, so each model instance runs at
+# most TTS_MAX_CONCURRENCY generations at once (default 1).
+class DynamicLimiter:
+    """Concurrency limiter whose maximum can be changed at runtime."""
+    
+    def __init__(self, max_concurrent: int = 2):
+        self._active = 0
+        self._max = max_concurrent
+        self._cond = asyncio.Condition()
+    
+    @property
+    def max_concurrent(self) -> int:
+        return self._max
+    
+    @property
+    def active(self) -> int:
+        return self._active
+    
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._max)
+            self._active += 1
+    
+    async def release(self):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+    
+    async def set_max(self, max_concurrent: int):
+        """Resize the limit. Waiters are woken if the limit grew."""
+        async with self._cond:
+            self._max = max_concurrent
+            self._cond.notify_all()
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+
+limiter = DynamicLimiter(config.MAX_CONCURRENCY)
+
+
+# Compressed output formats: (container, encoder, bit rate, media type)
+COMPRESSED_FORMATS = {
+    "opus": ("ogg", "libopus", 32000, "audio/ogg"),
+    "mp3": ("mp3", "mp3", 64000, "audio/mpeg"),
+}
+
+# Muxer options per container. The Ogg muxer otherwise buffers ~1s of audio
+# per page, so flush a page every 20ms for streaming.
+CONTAINER_OPTIONS = {
+    "ogg": {"page_duration": "20000"},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def compressed_format_available(response_format: str) -> bool:
+    """Whether a compressed format is requested and PyAV can encode it."""
+    if response_format not in COMPRESSED_FORMATS:
+        return False
+    try:
+        import av
+    except ImportError:
+        return False
+    
+    # PyAV builds can ship without some encoders (e.g. libmp3lame)
+    _, codec, _, _ = COMPRESSED_FORMATS[response_format]
+    try:
+        av.codec.Codec(codec, "w")
+    except Exception:
+        print(f"Encoder '{codec}' unavailable, serving {response_format} requests as WAV")
+        return False
+    return True
+
+
+class CompressedStreamEncoder:
+    """Incrementally encode int16 PCM chunks to Ogg/Opus or MP3 with PyAV."""
+    
+    def __init__(self, response_format: str, sample_rate: int):
+        import av
+        
+        container_format, codec, bit_rate, _ = COMPRESSED_FORMATS[response_format]
+        self._av = av
+        self._sample_rate = sample_rate
+        self._buffer = io.BytesIO()
+        self._pos = 0
+        self._container = av.open(
+            self._buffer, "w", format=container_format,
+            options=CONTAINER_OPTIONS.get(container_format, {})
+        )
+        self._stream = self._container.add_stream(codec, rate=sample_rate)
+        self._stream.layout = "mono"
+        self._stream.bit_rate = bit_rate
+    
+    def _drain(self) -> bytes:
+        """Return bytes muxed since the last call."""
+        with self._buffer.getbuffer() as view:
+            data = view[self._pos:].tobytes()
+        self._pos += len(data)
+        return data
+    
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+        frame = self._av.AudioFrame.from_ndarray(samples, format="s16", layout="mono")
+        frame.sample_rate = self._sample_rate
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
+        return self._drain()
+    
+    def close(self) -> bytes:
+        """Flush the encoder and write the container trailer."""
+        for packet in self._stream.encode(None):
+            self._container.mux(packet)
+        self._container.close()
+        return self._drain()
+
+
+def encode_compressed(audio: np.ndarray, response_format: str, sample_rate: int) -> bytes:
+    """Encode a complete float clip to a compressed format."""
+    pcm = np.clip(audio * 32767, -32768, 32767).astype(np.int16).tobytes()
+    encoder = CompressedStreamEncoder(response_format, sample_rate)
+    return encoder.encode(pcm) + encoder.close()
 
 class OpenAISpeechRequest(BaseModel):
     model: str = "pocket-tts"
@@ -98,10 +225,31 @@ async def startup_event():
     print("Starting Real-Time TTS Server")
     print("=" * 60)
     tts_engine = get_engine()
+    
+    # On CPU, concurrent inference would multiply PyTorch intra-op threads and
+    # thrash, so let each generation use every core (or this worker's share of
+    # them, as set by gunicorn's post_fork).
+    device = tts_engine.device
+    if device.type == "cpu":
+        torch.set_num_threads(int(os.getenv("TTS_TORCH_THREADS") or config.CPU_COUNT))
+    print(f"Concurrency limit: {limiter.max_concurrent} (model on {device})")
+    
+    # Dedicated, bounded pool for blocking generation calls, one worker per
+    # generation the limiter admits.
+    app.state.tts_exec = ThreadPoolExecutor(max_workers=config.MAX_CONCURRENCY, thread_name_prefix="tts")
+    
     print(f"Server ready at http://{config.HOST}:{config.PORT}")
     print("=" * 60)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the generation thread pool."""
+    tts_exec = getattr(app.state, "tts_exec", None)
+    if tts_exec is not None:
+        tts_exec.shutdown(wait=False, cancel_futures=True)
+
+
 @app.get("/")
 async def root():
     """Serve the main web interface."""
@@ -156,17 +304,20 @@ async def generate_audio(request: GenerateRequest):
     
     try:
         # Generate audio
-        start_time = time.time()
-        audio = tts_engine.generate(text, voice, stream=False, max_tokens=max_tokens)
-        generation_time = time.time() - start_time
+        async with limiter:
+            start_time = time.time()
+            audio = await asyncio.get_event_loop().run_in_executor(
+                app.state.tts_exec, tts_engine.generate, text, voice, False, max_tokens
+            )
+            generation_time = time.time() - start_time
         
         # Convert to WAV format
         buffer = io.BytesIO()
-        scipy.io.wavfile.write(buffer, tts_engine.sample_rate, audio)
+        sf.write(buffer, audio, tts_engine.sample_rate, subtype='PCM_16', format='WAV')
         buffer.seek(0)
         
         # Calculate metrics
-        audio_duration = len(audio) / tts_engine.sample_rate
+        audio_duration = len(audio) * tts_engine.inv_sample_rate
         rtf = generation_time / audio_duration if audio_duration > 0 else 0
         
         return StreamingResponse(
@@ -193,63 +344,76 @@ async def openai_speech(request: OpenAISpeechRequest):
     if not tts_engine:
         raise HTTPException(status_code=503, detail="TTS engine unavailable")
 
-    async with concurrency_semaphore:
-        if request.stream:
-            return StreamingResponse(
-                stream_generator(request.input, request.voice, 80), # Default max_tokens for stream
-                media_type="audio/wav"
+    # Opus/MP3 need PyAV; without it every format falls back to WAV
+    response_format = request.response_format if compressed_format_available(request.response_format) else "wav"
+    
+    if request.stream:
+        # The limiter is held by stream_generator for the lifetime of the stream
+        return StreamingResponse(
+            stream_generator(request.input, request.voice, 80, response_format), # Default max_tokens for stream
+            media_type=COMPRESSED_FORMATS[response_format][3] if response_format != "wav" else "audio/wav"
+        )
+    
+    async with limiter:
+        # Complete generation in thread pool to avoid blocking
+        loop = asyncio.get_event_loop()
+        try:
+            # Run blocking generation in executor
+            audio = await loop.run_in_executor(
+                app.state.tts_exec, tts_engine.generate, request.input, request.voice, False
             )
-        else:
-            # Complete generation in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            try:
-                # Run blocking generation in executor
-                audio = await loop.run_in_executor(
-                    None, 
-                    lambda: tts_engine.generate(request.input, request.voice, stream=False)
+            
+            # Convert to WAV/requested format
+            if response_format != "wav":
+                data = await loop.run_in_executor(
+                    app.state.tts_exec, encode_compressed, audio, response_format, tts_engine.sample_rate
                 )
-                
-                # Convert to WAV/requested format
-                import io
-                import scipy.io.wavfile
-                
-                buffer = io.BytesIO()
-                scipy.io.wavfile.write(buffer, tts_engine.sample_rate, audio)
-                buffer.seek(0)
-                
                 return StreamingResponse(
-                    buffer, 
-                    media_type="audio/wav",
-                    headers={"Content-Disposition": "attachment; filename=speech.wav"}
+                    io.BytesIO(data),
+                    media_type=COMPRESSED_FORMATS[response_format][3],
+                    headers={"Content-Disposition": f"attachment; filename=speech.{response_format}"}
                 )
-            except Exception as e:
-                print(f"Generation error: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
+            
+            buffer = io.BytesIO()
+            sf.write(buffer, audio, tts_engine.sample_rate, subtype='PCM_16', format='WAV')
+            buffer.seek(0)
+            
+            return StreamingResponse(
+                buffer, 
+                media_type="audio/wav",
+                headers={"Content-Disposition": "attachment; filename=speech.wav"}
+            )
+        except Exception as e:
+            print(f"Generation error: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
 
-async def stream_generator(text: str, voice: str, max_tokens: int):
+async def stream_generator(text: str, voice: str, max_tokens: int, response_format: str = "wav"):
     """Generator for streaming responses"""
-    import io
-    import scipy.io.wavfile
-    
-    # We yield wav headers first? No, for streaming raw audio, usually PCM or simple chunked wav is tricky.
-    # But browsers/clients often handle "stream of wav chunks" or just raw pcm.
-    # OpenAI returns chunks of the requested format.
-    # For simplicity, we stream raw PCM or WAV loop?
-    # Let's stream PCM bytes for compatibility with most raw consumers, OR
-    # wrap each chunk in a mini-wav (bad overhead).
-    # Best practice for modern streaming is usually just raw PCM or MP3 frames.
-    # PocketTTS yields raw float32/int16 samples.
-    
     try:
-        # Preamble (WAV header) - difficult if length unknown.
-        # So we skip WAV header for streaming and assume client handles raw or we use a container like MP3/Ogg if supported.
-        # But user requested WAV.
-        # We will stream raw samples for now, LiveKit agents usually handle raw or framing.
+        sr = tts_engine.sample_rate
+        encoder = None
+        if response_format in COMPRESSED_FORMATS:
+            encoder = CompressedStreamEncoder(response_format, sr)
+        else:
+            # WAV header with unknown length: size fields set to 0xFFFFFFFF so
+            # clients decode the stream as open-ended 16-bit mono PCM.
+            yield struct.pack(
+                '<4sI4s4sIHHIIHH4sI',
+                b'RIFF', 0xFFFFFFFF, b'WAVE',
+                b'fmt ', 16, 1, 1, sr, sr * 2, 2, 16,
+                b'data', 0xFFFFFFFF
+            )
         
-        for chunk in tts_engine.generate(text, voice, stream=True, max_tokens=max_tokens):
-            # chunk is numpy array. Convert to bytes.
-            yield chunk.tobytes()
-            await asyncio.sleep(0) # Yield to event loop
+        async with limiter:
+            pcm_stream = tts_engine.stream_pcm16(text, voice, max_tokens, executor=app.state.tts_exec)
+            async with aclosing(pcm_stream):
+                async for pcm in pcm_stream:
+                    data = encoder.encode(pcm) if encoder else pcm
+                    if data:
+                        yield data
+        
+        if encoder:
+            yield encoder.close()
             
     except Exception as e:
         print(f"Streaming error: {e}")
@@ -258,44 +422,38 @@ async def stream_generator(text: str, voice: str, max_tokens: int):
 async def batch_generate(request: BatchRequest):
     """
     Generate audio for multiple texts in batch.
-    Requests are processed sequentially.
+    Items are submitted together and admitted by the generation limiter.
     """
-    results = []
-    
-    # We process sequentially to avoid OOM/thrashing
-    # In a real production app, this would queue a Celery job.
-    # Here, for "Launch MVP", we process async but await them.
+    loop = asyncio.get_event_loop()
     
-    for req in request.requests:
+    async def _one(req: GenerateRequest) -> dict:
         try:
-            # Generate (reuse openai logic or direct)
-            # We'll call the direct generate endpoint logic internally or just call engine
-             audio = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                lambda: tts_engine.generate(req.text, req.voice, stream=False)
-            )
-             # Encode to base64 for JSON response
-             import base64
-             import io
-             import scipy.io.wavfile
-             
-             buf = io.BytesIO()
-             scipy.io.wavfile.write(buf, tts_engine.sample_rate, audio)
-             b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-             
-             results.append({
-                 "text": req.text,
-                 "status": "success",
-                 "audio_base64": b64
-             })
+            async with limiter:
+                audio = await loop.run_in_executor(
+                    app.state.tts_exec, tts_engine.generate, req.text, req.voice, False
+                )
+            
+            # Encode to base64 for JSON response
+            buf = io.BytesIO()
+            sf.write(buf, audio, tts_engine.sample_rate, subtype='PCM_16', format='WAV')
+            b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
+            
+            return {
+                "text": req.text,
+                "status": "success",
+                "audio_base64": b64
+            }
         except Exception as e:
-             results.append({
-                 "text": req.text,
-                 "status": "error",
-                 "error": str(e)
-             })
-             
-    return {"results": results}
+            return {
+                "text": req.text,
+                "status": "error",
+                "error": str(e)
+            }
+    
+    # The limiter runs one generation per model at a time, so items queue
+    # behind it; WAV/base64 encoding of finished items overlaps later ones
+    results = await asyncio.gather(*[_one(req) for req in request.requests])
+    return {"results": list(results)}
 
 
 @app.post("/api/upload-voice")
@@ -322,14 +480,16 @@ async def upload_voice(file: UploadFile = File(...)):
     try:
         # Save uploaded file
         file_path = config.UPLOADED_VOICES_DIR / file.filename
-        content = await file.read()
         
+        # Stream to disk in 1 MiB chunks to keep memory bounded per upload
         with open(file_path, "wb") as f:
-            f.write(content)
+            while chunk := await file.read(1 << 20):
+                f.write(chunk)
         
         # Optionally export to safetensors for faster loading
         safetensors_path = file_path.with_suffix(".safetensors")
         tts_engine.export_voice(file_path, safetensors_path)
+        tts_engine.invalidate_voice_path(file_path.stem)
         
         return {
             "success": True,
@@ -350,7 +510,9 @@ async def websocket_stream(websocket: WebSocket):
     
     Protocol:
         Client sends: {"text": "...", "voice": "alba"}
-        Server sends: {"type": "audio", "data": [...]} or {"type": "done", "metrics": {...}}
+        Server sends: {"type": "start", "sample_rate": ..., "dtype": "int16"},
+                      then binary frames of little-endian int16 PCM,
+                      then {"type": "done", "metrics": {...}}
     """
     await websocket.accept()
     
@@ -373,30 +535,31 @@ async def websocket_stream(websocket: WebSocket):
             
             # Generate and stream audio
             try:
-                start_time = time.time()
-                first_chunk_time = None
-                total_samples = 0
-                
-                # Stream audio chunks
-                for chunk in tts_engine.generate(text, voice, stream=True, max_tokens=max_tokens):
-                    if first_chunk_time is None:
-                        first_chunk_time = time.time() - start_time
-                    
-                    total_samples += len(chunk)
+                async with limiter:
+                    start_time = time.time()
+                    first_chunk_time = None
+                    total_samples = 0
                     
-                    # Send audio chunk as JSON (convert to list for JSON serialization)
+                    # Announce the binary audio format before the first chunk
                     await websocket.send_json({
-                        "type": "audio",
-                        "data": chunk.tolist(),
-                        "sample_rate": tts_engine.sample_rate
+                        "type": "start",
+                        "sample_rate": tts_engine.sample_rate,
+                        "dtype": "int16"
                     })
                     
-                    # Yield control to event loop without artificial delay
-                    await asyncio.sleep(0)
+                    # Stream audio chunks as binary int16 PCM frames
+                    pcm_stream = tts_engine.stream_pcm16(text, voice, max_tokens, executor=app.state.tts_exec)
+                    async with aclosing(pcm_stream):
+                        async for pcm in pcm_stream:
+                            if first_chunk_time is None:
+                                first_chunk_time = time.time() - start_time
+                            
+                            total_samples += len(pcm) // 2
+                            await websocket.send_bytes(pcm)
                 
                 # Send completion message with metrics
                 total_time = time.time() - start_time
-                audio_duration = total_samples / tts_engine.sample_rate
+                audio_duration = total_samples * tts_engine.inv_sample_rate
                 rtf = total_time / audio_duration if audio_duration > 0 else 0
                 
                 await websocket.send_json({
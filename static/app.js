@@ -141,6 +141,7 @@ class ChatController {
     connectWS() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         this.socket = new WebSocket(`${protocol}//${window.location.host}/ws/stream`);
+        this.socket.binaryType = 'arraybuffer';
 
         this.socket.onopen = () => {
             this.isConnected = true;
@@ -153,7 +154,14 @@ class ChatController {
             setTimeout(() => this.connectWS(), 3000);
         };
 
-        this.socket.onmessage = (e) => this.handleMessage(JSON.parse(e.data));
+        this.socket.onmessage = (e) => {
+            if (e.data instanceof ArrayBuffer) {
+                // Binary frames carry int16 PCM audio
+                if (this.currentStreamController) this.currentStreamController.feed(new Int16Array(e.data));
+            } else {
+                this.handleMessage(JSON.parse(e.data));
+            }
+        };
     }
 
     updateStatus(online) {
@@ -291,8 +299,8 @@ class ChatController {
     handleMessage(msg) {
         if (!this.currentStreamController) return;
 
-        if (msg.type === 'audio') {
-            this.currentStreamController.feed(msg.data);
+        if (msg.type === 'start') {
+            // Audio follows as binary frames
         } else if (msg.type === 'done') {
             const blob = this.currentStreamController.finish(msg.metrics);
 
@@ -414,8 +422,9 @@ class AudioStreamController {
     }
 
     feed(chunk) {
-        // Convert to Float32
-        const float32 = new Float32Array(chunk);
+        // Convert int16 PCM to Float32
+        const float32 = new Float32Array(chunk.length);
+        for (let i = 0; i < chunk.length; i++) float32[i] = chunk[i] / 32768;
         this.audioChunks.push(float32); // Store for blob
 
         const buffer = this.ctx.createBuffer(1, float32.length, this.ctx.sampleRate);
@@ -1,8 +1,12 @@
 """Core TTS Engine wrapper for Pocket TTS with streaming support."""
 
+import asyncio
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Optional, Union, Iterator
+from typing import Optional, Union, Iterator, AsyncIterator
 import numpy as np
 import torch
 from pocket_tts import TTSModel, export_model_state
@@ -35,7 +39,8 @@ class TTSEngine:
             print("Loading Pocket TTS with Voice Cloning (this may take a moment to download weights)...")
             self.model = TTSModel.load_model(
                 temp=0.7,
-                lsd_decode_steps=1
+                lsd_decode_steps=1,
+                quantize=config.QUANTIZE_INT8
             )
             print("Voice Cloning Model Loaded Successfully!")
         except Exception as e:
@@ -50,6 +55,7 @@ class TTSEngine:
                 self.model = TTSModel.load_model(
                     temp=0.7,
                     lsd_decode_steps=1,
+                    quantize=config.QUANTIZE_INT8,
                     voice_cloning=False # Hypothetical flag based on error context
                 )
             except TypeError:
@@ -61,14 +67,69 @@ class TTSEngine:
                  raise e
 
         self.sample_rate = self.model.sample_rate
+        self.inv_sample_rate = 1.0 / self.sample_rate  # Samples -> seconds
+        
+        if config.TORCH_COMPILE:
+            self._compile_model()
+        
         load_time = time.time() - start_time
         print(f"Model loaded in {load_time:.2f}s")
         
-        # Cache for voice states
-        self.voice_cache = {}
+        # LRU cache for voice states, bounded by entry count and memory budget
+        self.voice_cache = OrderedDict()
+        self._cache_sizes = {}
+        self._cache_bytes = 0
+        self._cache_budget = config.VOICE_CACHE_MB * 1024 * 1024
+        
+        # Uploaded voice name -> (resolved path, lookup time)
+        self._voice_path_cache: dict[str, tuple[str, float]] = {}
+        
+        # Per-thread scratch buffers for float -> int16 PCM conversion
+        self._scratch = threading.local()
         
         # Preload common voices
         self._preload_voices()
+        
+        # Pay the compile cost now rather than on the first request
+        if config.TORCH_COMPILE:
+            self._warmup()
+    
+    @property
+    def device(self) -> torch.device:
+        """Device holding the model's parameters."""
+        try:
+            return next(self.model.parameters()).device
+        except (AttributeError, StopIteration):
+            return torch.device("cpu")
+    
+    def _compile_model(self):
+        """Compile the flow LM with torch.compile."""
+        # TTSModel drives generation from its own Python methods rather than
+        # forward(). flow_lm is the only submodule invoked through __call__
+        # (Mimi is used via decode_from_latent), so it is the one worth compiling.
+        if not hasattr(torch.nn.Module, "compile"):
+            print("torch.compile unavailable, running eagerly")
+            return
+        try:
+            # Fall back to eager for any graph that fails to compile
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            
+            self.model.flow_lm.compile(dynamic=True)
+            print("Compiled flow_lm")
+        except Exception as e:
+            print(f"torch.compile failed: {e}")
+    
+    def _warmup(self):
+        """Run a short generation with each cached voice to trigger compilation."""
+        print("Warming up compiled model...")
+        start_time = time.time()
+        for voice_key, voice_state in list(self.voice_cache.items()):
+            try:
+                self.model.generate_audio(voice_state, "Hello.", copy_state=True)
+            except Exception as e:
+                print(f"  [FAIL] Warmup failed for {voice_key}: {e}")
+        print(f"Warmup done in {time.time() - start_time:.2f}s")
     
     def _preload_voices(self):
         """Preload common pre-made voices for faster access."""
@@ -94,23 +155,14 @@ class TTSEngine:
         
         # Check if it is a simple name (not a path) and not in pre-made voices
         # We try to resolve it to a file in uploads directory
-        if "/" not in voice_str and "\\" not in voice_str and voice_str not in config.PREMADE_VOICES:
-            # Check for safetensors first (faster)
-            safetensors_path = config.UPLOADED_VOICES_DIR / f"{voice_str}.safetensors"
-            wav_path = config.UPLOADED_VOICES_DIR / f"{voice_str}.wav"
-            mp3_path = config.UPLOADED_VOICES_DIR / f"{voice_str}.mp3"
-            
-            if safetensors_path.exists():
-                voice = str(safetensors_path)
-            elif wav_path.exists():
-                voice = str(wav_path)
-            elif mp3_path.exists():
-                voice = str(mp3_path)
+        if "/" not in voice_str and "\\" not in voice_str and voice_str not in config.PREMADE_VOICES_SET:
+            voice = self._resolve_uploaded_voice(voice_str)
                 
         voice_key = str(voice)
         
         # Check cache first
         if voice_key in self.voice_cache:
+            self.voice_cache.move_to_end(voice_key)
             return self.voice_cache[voice_key]
         
         # Load new voice state
@@ -126,17 +178,62 @@ class TTSEngine:
         load_time = time.time() - start_time
         
         # Cache it
-        self.voice_cache[voice_key] = voice_state
+        self._cache_put(voice_key, voice_state)
         print(f"Loaded voice '{voice}' in {load_time:.2f}s")
         
         return voice_state
+    
+    def _resolve_uploaded_voice(self, name: str) -> str:
+        """Resolve an uploaded voice name to its file, memoized for a short TTL."""
+        now = time.monotonic()
+        cached = self._voice_path_cache.get(name)
+        if cached is not None and now - cached[1] < config.VOICE_PATH_CACHE_TTL:
+            return cached[0]
+        
+        # Check for safetensors first (faster)
+        resolved = name
+        for suffix in (".safetensors", ".wav", ".mp3"):
+            path = config.UPLOADED_VOICES_DIR / f"{name}{suffix}"
+            if path.exists():
+                resolved = str(path)
+                break
+        
+        self._voice_path_cache[name] = (resolved, now)
+        return resolved
+    
+    def invalidate_voice_path(self, name: str):
+        """Forget the memoized file lookup for an uploaded voice."""
+        self._voice_path_cache.pop(name, None)
+    
+    def _cache_put(self, voice_key: str, voice_state):
+        """Insert a voice state, evicting least recently used entries over budget."""
+        size = _state_nbytes(voice_state)
+        # Two threads can miss on the same key; replace rather than double-count
+        if voice_key in self.voice_cache:
+            self._cache_bytes -= self._cache_sizes.pop(voice_key, 0)
+        self.voice_cache[voice_key] = voice_state
+        self.voice_cache.move_to_end(voice_key)
+        self._cache_sizes[voice_key] = size
+        self._cache_bytes += size
+        
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while len(self.voice_cache) > 1 and (
+            len(self.voice_cache) > config.VOICE_CACHE_MAX_ENTRIES
+            or self._cache_bytes > self._cache_budget
+        ):
+            evicted_key, _ = self.voice_cache.popitem(last=False)
+            self._cache_bytes -= self._cache_sizes.pop(evicted_key)
+            print(f"Evicted voice '{evicted_key}' from cache")
+    
     def generate(
         self,
         text: str,
         voice: Union[str, Path] = "alba",
         stream: bool = False,
         max_tokens: int = 80,  # Smaller default for lower latency
-        speed_factor: float = 1.0  # Dummy param for now, could adjust temp/steps
+        speed_factor: float = 1.0,  # Dummy param for now, could adjust temp/steps
+        copy_state: bool = True,
+        stop: Optional[threading.Event] = None
     ) -> Union[np.ndarray, Iterator[np.ndarray]]:
         """
         Generate speech from text.
@@ -147,6 +244,11 @@ class TTSEngine:
             stream: Whether to stream
             max_tokens: Text chunk size (smaller = lower latency)
             speed_factor: Multiplier for generation speed (affects quality)
+            copy_state: Copy the voice state before generating. Generation
+                mutates the state, and cached states are reused by later
+                requests, so only pass False for a state that is used once.
+            stop: Event that aborts a streaming generation, including the
+                model's own generation threads, when set
         """
         if len(text) > config.MAX_TEXT_LENGTH:
             raise ValueError(f"Text too long. Maximum {config.MAX_TEXT_LENGTH} characters.")
@@ -154,15 +256,22 @@ class TTSEngine:
         voice_state = self.get_voice_state(voice)
         
         if stream:
-            return self._generate_streaming(voice_state, text, max_tokens)
+            return self._generate_streaming(voice_state, text, max_tokens, copy_state, stop)
         else:
-            return self._generate_complete(voice_state, text)
+            return self._generate_complete(voice_state, text, copy_state)
     
-    def _generate_complete(self, voice_state, text: str) -> np.ndarray:
+    def _generate_complete(self, voice_state, text: str, copy_state: bool = True) -> np.ndarray:
         # ... (implementation same as before)
-        return self.model.generate_audio(voice_state, text, copy_state=True).numpy()
+        return self.model.generate_audio(voice_state, text, copy_state=copy_state).numpy()
 
-    def _generate_streaming(self, voice_state, text: str, max_tokens: int) -> Iterator[np.ndarray]:
+    def _generate_streaming(
+        self,
+        voice_state,
+        text: str,
+        max_tokens: int,
+        copy_state: bool = True,
+        stop: Optional[threading.Event] = None
+    ) -> Iterator[np.ndarray]:
         """
         Generate audio in streaming chunks.
         """
@@ -170,16 +279,123 @@ class TTSEngine:
         stream_iterator = self.model.generate_audio_stream(
             voice_state, 
             text, 
-            copy_state=True,
-            max_tokens=max_tokens
+            copy_state=copy_state,
+            max_tokens=max_tokens,
+            stop=stop
         )
         
-        # Yield chunks
+        # pocket-tts already pipelines generation and decoding internally.
+        # Optionally (STREAM_COALESCE_SAMPLES > 0) coalesce frames after the
+        # first into larger chunks so fewer cross the queue and the socket;
+        # by default every frame is yielded as soon as it is decoded.
+        pending = []
+        pending_samples = 0
+        first = True
         for chunk in stream_iterator:
             if isinstance(chunk, torch.Tensor):
-                yield chunk.cpu().numpy()
-            else:
+                chunk = chunk.cpu().numpy()
+            
+            if first:
+                first = False
                 yield chunk
+                continue
+            
+            pending.append(chunk)
+            pending_samples += len(chunk)
+            if pending_samples >= config.STREAM_COALESCE_SAMPLES:
+                yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+                pending = []
+                pending_samples = 0
+        
+        if pending:
+            yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+    
+    async def stream_pcm16(
+        self,
+        text: str,
+        voice: Union[str, Path] = "alba",
+        max_tokens: int = 80,
+        executor: Optional[Executor] = None
+    ) -> AsyncIterator[bytes]:
+        """
+        Stream int16 PCM bytes, running the model in a worker thread.
+        
+        A producer thread drives the model's streaming iterator and fills a
+        bounded queue, so generation of the next chunk overlaps with encoding
+        and sending the current one, and the event loop never runs model code.
+        
+        Args:
+            text: Text to convert to speech
+            voice: Voice to use
+            max_tokens: Text chunk size (smaller = lower latency)
+            executor: Executor for the producer thread (default pool if None)
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=config.STREAM_BUFFER_SIZE)
+        stop = threading.Event()
+        
+        def put(item):
+            # Blocks the producer thread while the queue is full
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        
+        def producer():
+            chunks = None
+            try:
+                # Closing the iterator alone leaves pocket-tts's generation
+                # threads running; the stop event halts them too
+                chunks = self.generate(text, voice, stream=True, max_tokens=max_tokens, stop=stop)
+                for chunk in chunks:
+                    if stop.is_set():
+                        return
+                    put(self.to_pcm16(chunk))
+                put(None)
+            except Exception as e:
+                if not stop.is_set():
+                    put(e)
+            finally:
+                if chunks is not None:
+                    chunks.close()
+        
+        producer_future = loop.run_in_executor(executor, producer)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # Unblock a producer waiting on a full queue, then wait for it to exit
+            while not producer_future.done():
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({producer_future, getter}, return_when=asyncio.FIRST_COMPLETED)
+                getter.cancel()
+    
+    def to_pcm16(self, audio: np.ndarray) -> bytes:
+        """
+        Convert float audio in [-1, 1] to little-endian int16 PCM bytes.
+        
+        Reuses pre-allocated buffers so streaming chunks don't allocate
+        intermediate arrays. Buffers are per thread, so concurrent streams
+        never share them.
+        """
+        audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+        n = audio.shape[0]
+        
+        scratch = self._scratch
+        f32 = getattr(scratch, "f32", None)
+        if f32 is None or f32.shape[0] < n:
+            size = max(n, config.CHUNK_SIZE + 1024)
+            scratch.f32 = f32 = np.empty(size, dtype=np.float32)
+            scratch.i16 = np.empty(size, dtype=np.int16)
+        i16 = scratch.i16
+        
+        np.multiply(audio, 32767.0, out=f32[:n])
+        np.clip(f32[:n], -32768, 32767, out=f32[:n])
+        i16[:n] = f32[:n]
+        return i16[:n].tobytes()
     
     def export_voice(self, audio_path: Union[str, Path], output_path: Union[str, Path]):
         """
@@ -238,9 +454,22 @@ class TTSEngine:
     def clear_cache(self):
         """Clear the voice cache to free memory."""
         self.voice_cache.clear()
+        self._cache_sizes.clear()
+        self._cache_bytes = 0
         print("Voice cache cleared")
 
 
+def _state_nbytes(state) -> int:
+    """Estimate the memory held by the tensors in a (possibly nested) voice state."""
+    if torch.is_tensor(state):
+        return state.numel() * state.element_size()
+    if isinstance(state, dict):
+        return sum(_state_nbytes(v) for v in state.values())
+    if isinstance(state, (list, tuple)):
+        return sum(_state_nbytes(v) for v in state)
+    return 0
+
+
 # Singleton instance
 _engine_instance: Optional[TTSEngine] = None
 